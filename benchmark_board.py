@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import argparse, random, time
+
+import board, database_prepared
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples)-1, int(len(samples)*p/100))]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", "-i", type=int, default=1000)
+    parser.add_argument("--window", type=int, default=7200, help="Board window, in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    with database_prepared.Connection(groups=["board"]) as connection, connection.cursor() as c:
+        # Sample from what's actually been flattened, weighted by traffic, so that busy stations come up more often
+        c.execute("""SELECT l.crs FROM flat_timing ft JOIN locations l ON l.iid=ft.location_iid
+            WHERE l.crs IS NOT NULL AND ft.departure_scheduled IS NOT NULL
+            ORDER BY random() LIMIT %s;""", (args.iterations,))
+        stations = [a[0] for a in c.fetchall()]
+        c.execute("SELECT MIN(departure_scheduled), MAX(departure_scheduled) FROM flat_timing;")
+        earliest, latest = c.fetchone()
+        c.execute("SELECT iid FROM flat_schedules WHERE schedule_validity_iid IS NOT NULL ORDER BY random() LIMIT %s;", (args.iterations,))
+        services = [a[0] for a in c.fetchall()]
+
+        if not stations or not services:
+            print("No flattened schedules, run flat_maintenance.py first")
+            exit()
+
+        queries = [
+            ("departures", lambda: board.departures(c, random.choice(stations), *window())),
+            ("arrivals",   lambda: board.arrivals(c, random.choice(stations), *window())),
+            ("service",    lambda: board.service(c, random.choice(services))),
+            ]
+
+        def window():
+            start = random.randint(earliest, max(earliest, latest-args.window))
+            return start, start+args.window
+
+        print("{:<12} {:>10} {:>10} {:>10}".format("query", "p50 (ms)", "p99 (ms)", "rows"))
+        for name, query in queries:
+            timings, rows = [], 0
+            for n in range(args.iterations):
+                start = time.perf_counter()
+                rows += len(query())
+                timings.append((time.perf_counter()-start)*1000)
+            print("{:<12} {:>10.2f} {:>10.2f} {:>10.1f}".format(
+                name, percentile(timings, 50), percentile(timings, 99), rows/args.iterations))
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import argparse, datetime
+
+import database_prepared
+
+# Cursors have to come from a database_prepared.Connection with the board group
+def _board(c, name, crs, time_from, time_to, limit, passenger):
+    c.execute(database_prepared.sql(name if passenger else name + "_all"), (crs, time_from, time_to, limit))
+    return c.fetchall()
+
+# Times are UNIX timestamps, as they are in flat_timing
+def departures(c, crs, time_from, time_to, limit=50, passenger=True):
+    return _board(c, "board_departures", crs, time_from, time_to, limit, passenger)
+
+def arrivals(c, crs, time_from, time_to, limit=50, passenger=True):
+    return _board(c, "board_arrivals", crs, time_from, time_to, limit, passenger)
+
+def service(c, flat_schedule_iid):
+    c.execute(database_prepared.sql("board_service"), (flat_schedule_iid,))
+    return c.fetchall()
+
+def f_time(timestamp):
+    if timestamp is None:
+        return "    "
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%H%M")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("crs")
+    parser.add_argument("--arrivals", "-a", action="store_true")
+    parser.add_argument("--hours", type=float, default=2)
+    parser.add_argument("--all", action="store_true", help="Include non-passenger calls")
+    args = parser.parse_args()
+
+    now = int(datetime.datetime.now().timestamp())
+    with database_prepared.Connection(groups=["board"]) as connection, connection.cursor() as c:
+        board = arrivals if args.arrivals else departures
+        for iid, uid, start_date, trust_id, signalling_id, atoc_code, scheduled, public, platform, origin, destination, variation, current, cancelled in board(
+                c, args.crs.upper(), now, now+int(args.hours*3600), passenger=not args.all):
+            print("{} {:<4} {:<2} {:<3} {:<32} {}".format(
+                f_time(scheduled), signalling_id or "", atoc_code or "", platform or "",
+                (origin if args.arrivals else destination) or "",
+                "Cancelled" if cancelled else "{:+}".format(variation) if variation is not None else ""))
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from common.database import DatabaseConnection
+import database_structure
+
+# name -> (group, parameter types, statement)
+# DAYS and CODE parameter types stand for weekday masks and single character codes, which depend on compact_codes
+STATEMENTS = OrderedDict()
+
+def register(group, name, types, statement):
+    STATEMENTS[name] = (group, types, statement)
+
+# For use with execute/execute_batch, ie c.execute(sql("insert_flat_timing"), args)
+def sql(name):
+    group, types, statement = STATEMENTS[name]
+    return "EXECUTE {} ({});".format(name, ", ".join(["%s"]*len(types)))
+
+# A database connection with the registered statements in the given groups prepared
+class Connection:
+    def __init__(self, groups=None):
+        self.statements = [k for k,v in STATEMENTS.items() if groups is None or v[0] in groups]
+        self._connection = None
+
+    def _connect(self):
+        connection = DatabaseConnection().__enter__()
+        # Prepared statements only last as long as the session
+        try:
+            with connection.new_cursor() as c:
+                column_types = database_structure.column_types(database_structure.options(c))
+                type_map = {"DAYS": column_types["days"], "CODE": column_types["code"]}
+                for name in self.statements:
+                    group, types, statement = STATEMENTS[name]
+                    c.execute("PREPARE {} ({}) AS {}".format(name, ", ".join([type_map.get(a, a) for a in types]), statement))
+        except BaseException:
+            connection.__exit__(None, None, None)
+            raise
+        return connection
+
+    # After an error, the connection could be mid-way through an aborted transaction, or closed
+    def _rollback(self):
+        try:
+            with self._connection.new_cursor() as c:
+                c.execute("ROLLBACK;")
+        except Exception:
+            # Replaced on next use, statements and all
+            try:
+                self.close()
+            except Exception:
+                self._connection = None
+
+    @contextmanager
+    def cursor(self):
+        if not self._connection:
+            self._connection = self._connect()
+        try:
+            with self._connection.new_cursor() as c:
+                yield c
+        except BaseException:
+            self._rollback()
+            raise
+
+    def close(self):
+        if self._connection:
+            connection, self._connection = self._connection, None
+            connection.__exit__(None, None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# parser.py, renew_schedules.py
+register("cif", "upsert_schedule_validity", ["CHAR(6)", "DATE", "DATE", "DAYS", "CODE", "CODE"],
+    """INSERT INTO schedule_validities VALUES (DEFAULT, $1, $2, $3, $4, $5, $6)
+    ON CONFLICT (uid, valid_from, stp) DO
+        UPDATE SET (uid, valid_from, valid_to, weekdays, bank_holiday_running, stp)=
+        (EXCLUDED.uid, EXCLUDED.valid_from, EXCLUDED.valid_to, EXCLUDED.weekdays, EXCLUDED.bank_holiday_running, EXCLUDED.stp)
+    RETURNING iid;""")
+register("cif", "upsert_schedule", ["INTEGER", "SMALLINT", "CODE", "VARCHAR(2)", "VARCHAR(4)", "VARCHAR(4)", "CODE",
+    "VARCHAR(3)", "VARCHAR(7)", "VARCHAR(3)", "VARCHAR(6)", "CODE", "CODE", "CODE", "VARCHAR(4)", "VARCHAR(4)",
+    "VARCHAR(4)", "VARCHAR(5)", "VARCHAR(2)", "CODE"],
+    """INSERT INTO schedules VALUES (DEFAULT, $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, $17, $18, $19, $20)
+    ON CONFLICT (validity_iid, segment_instance) DO UPDATE SET (status, category, signalling_id,
+        headcode, business_sector, power_type, timing_load, speed, operating_characteristics, seating_class, sleepers,
+        reservations, catering, branding, traction_class, uic_code, atoc_code, applicable_timetable)=(
+        EXCLUDED.status, EXCLUDED.category,
+        EXCLUDED.signalling_id, EXCLUDED.headcode, EXCLUDED.business_sector, EXCLUDED.power_type, EXCLUDED.timing_load,
+        EXCLUDED.speed, EXCLUDED.operating_characteristics, EXCLUDED.seating_class, EXCLUDED.sleepers,
+        EXCLUDED.reservations, EXCLUDED.catering, EXCLUDED.branding, EXCLUDED.traction_class, EXCLUDED.uic_code,
+        EXCLUDED.atoc_code, EXCLUDED.applicable_timetable) RETURNING iid;""")
+register("cif", "insert_schedule_location", ["INTEGER", "INTEGER", "VARCHAR(1)", "SMALLINT", "SMALLINT", "SMALLINT", "VARCHAR(4)",
+    "VARCHAR(4)", "VARCHAR(3)", "VARCHAR(3)", "VARCHAR(3)", "VARCHAR(12)", "VARCHAR(2)", "VARCHAR(2)", "VARCHAR(2)"],
+    "INSERT INTO schedule_locations VALUES (DEFAULT, $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15);")
+register("cif", "delete_schedule_locations", ["INTEGER"],
+    "DELETE FROM schedule_locations WHERE schedule_iid=$1;")
+register("cif", "upsert_association", ["CHAR(6)", "CHAR(6)", "DATE", "DATE", "DAYS", "VARCHAR(2)", "CODE", "VARCHAR(7)",
+    "VARCHAR(1)", "VARCHAR(1)", "CODE", "CODE"],
+    """INSERT INTO associations VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)
+    ON CONFLICT (uid, uid_assoc, valid_from, stp)
+    DO UPDATE SET (valid_to, assoc_days, category, date_indicator, tiploc, suffix, suffix_assoc, type, flattened_to)=
+    (EXCLUDED.valid_to, EXCLUDED.assoc_days, EXCLUDED.category, EXCLUDED.date_indicator, EXCLUDED.tiploc,
+    EXCLUDED.suffix, EXCLUDED.suffix_assoc, EXCLUDED.type, NULL);""")
+register("cif", "insert_pattern", ["CHAR(40)"],
+    "INSERT INTO schedule_patterns(hash) VALUES ($1) RETURNING iid;")
+register("cif", "insert_pattern_location", ["INTEGER", "INTEGER", "VARCHAR(1)", "SMALLINT", "SMALLINT", "SMALLINT", "VARCHAR(4)",
+    "VARCHAR(4)", "VARCHAR(3)", "VARCHAR(3)", "VARCHAR(3)", "VARCHAR(12)", "VARCHAR(2)", "VARCHAR(2)", "VARCHAR(2)"],
+    """INSERT INTO schedule_locations (pattern_iid, location_iid, tiploc_instance, arrival_time, departure_time, pass_time,
+    arrival_public, departure_public, platform, line, path, activity, engineering_allowance, pathing_allowance, performance_allowance)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15);""")
+register("cif", "update_schedule_pattern", ["INTEGER", "INTEGER"],
+    "UPDATE schedules SET pattern_iid=$1 WHERE iid=$2;")
+register("cif", "delete_association", ["CHAR(6)", "CHAR(6)", "DATE", "CODE"],
+    "DELETE FROM associations WHERE uid=$1 AND uid_assoc=$2 AND valid_from=$3 AND stp=$4;")
+
+# flat_maintenance.py
+register("flat", "select_flat_validities", ["CHAR(7)", "DATE", "DATE"],
+    """SELECT iid, uid, stp, weekdays, valid_from, valid_to, flattened_to FROM schedule_validities
+    WHERE uid=$1 AND valid_to >= $2 AND valid_from <= $3 ORDER BY stp DESC;""")
+# Locations either belong to the schedule itself, or to its calling pattern
+register("flat", "select_flat_locations", ["INTEGER"],
+    """SELECT sl.iid, sl.location_iid, sl.arrival_time, sl.departure_time, sl.pass_time FROM schedule_locations sl
+        JOIN schedules s ON s.iid=sl.schedule_iid WHERE s.validity_iid=$1
+    UNION ALL
+    SELECT sl.iid, sl.location_iid, sl.arrival_time, sl.departure_time, sl.pass_time FROM schedule_locations sl
+        JOIN schedules s ON s.pattern_iid=sl.pattern_iid WHERE s.validity_iid=$1
+    ORDER BY iid;""")
+register("flat", "insert_flat_schedule", ["INTEGER", "CHAR(7)", "DATE"],
+    "INSERT INTO flat_schedules VALUES (DEFAULT, $1, $2, $3) RETURNING iid;")
+register("flat", "insert_flat_timing", ["BIGINT", "BIGINT", "INT", "BIGINT", "BIGINT", "BIGINT"],
+    "INSERT INTO flat_timing VALUES ($1, $2, $3, $4, $5, $6);")
+register("flat", "select_flat_associations", ["CHAR(6)", "CHAR(6)", "DATE", "DATE"],
+    """SELECT tiploc, stp, assoc_days, valid_from, valid_to, category, date_indicator, suffix, suffix_assoc, type, flattened_to
+    FROM associations WHERE uid=$1 AND uid_assoc=$2 AND valid_to >= $3 AND valid_from <= $4 ORDER BY stp DESC;""")
+register("flat", "insert_flat_association", ["CHAR(6)", "CHAR(6)", "DATE", "VARCHAR(7)", "VARCHAR(2)", "CODE", "VARCHAR(1)",
+    "VARCHAR(1)", "CODE", "DATE"],
+    """INSERT INTO flat_associations
+    SELECT fs.iid, fs_assoc.iid, $1, $2, $3, (SELECT iid FROM locations WHERE tiploc=$4), $5, $6, $7, $8, $9
+    FROM flat_schedules fs, flat_schedules fs_assoc
+    WHERE fs.uid=$1 AND fs.start_date=$3 AND fs_assoc.uid=$2 AND fs_assoc.start_date=$10;""")
+
+# lazy_flat.py
+register("flat", "select_lazy_uids", ["INTEGER", "DATE"],
+    """SELECT sv.uid FROM schedule_locations sl
+        JOIN schedules s ON s.iid=sl.schedule_iid
+        JOIN schedule_validities sv ON sv.iid=s.validity_iid
+        WHERE sl.location_iid=$1 AND sv.valid_from <= $2 AND sv.valid_to >= $2 AND runs_on(sv.weekdays, $2)
+    UNION
+    SELECT sv.uid FROM schedule_locations sl
+        JOIN schedules s ON s.pattern_iid=sl.pattern_iid
+        JOIN schedule_validities sv ON sv.iid=s.validity_iid
+        WHERE sl.location_iid=$1 AND sv.valid_from <= $2 AND sv.valid_to >= $2 AND runs_on(sv.weekdays, $2);""")
+# The running validity for each uid, taken in the same order as select_flat_validities, and its locations
+register("flat", "select_lazy_flat_uids", ["CHAR(7)[]", "DATE"],
+    """WITH running AS (
+        SELECT DISTINCT ON (uid) uid, iid, stp FROM schedule_validities
+        WHERE uid=ANY($1) AND valid_from <= $2 AND valid_to >= $2 AND runs_on(weekdays, $2)
+        ORDER BY uid, stp)
+    SELECT r.uid, r.iid, sl.iid, sl.location_iid, sl.arrival_time, sl.departure_time, sl.pass_time FROM running r
+        JOIN schedules s ON s.validity_iid=r.iid
+        JOIN schedule_locations sl ON sl.schedule_iid=s.iid WHERE r.stp<>'C'
+    UNION ALL
+    SELECT r.uid, r.iid, sl.iid, sl.location_iid, sl.arrival_time, sl.departure_time, sl.pass_time FROM running r
+        JOIN schedules s ON s.validity_iid=r.iid
+        JOIN schedule_locations sl ON sl.pattern_iid=s.pattern_iid WHERE r.stp<>'C'
+    ORDER BY 1, 3;""")
+register("flat", "select_materialised_uid", ["CHAR(7)", "DATE"],
+    """SELECT fs.schedule_validity_iid, ft.schedule_location_iid, ft.location_iid, ft.arrival_scheduled, ft.departure_scheduled, ft.pass_scheduled
+    FROM flat_schedules fs JOIN flat_timing ft ON ft.flat_schedule_iid=fs.iid
+    WHERE fs.uid=$1 AND fs.start_date=$2 ORDER BY ft.schedule_location_iid;""")
+register("flat", "select_materialised_location", ["INTEGER", "DATE"],
+    """SELECT fs.uid, fs.schedule_validity_iid, ft.schedule_location_iid, ft.location_iid, ft.arrival_scheduled, ft.departure_scheduled, ft.pass_scheduled
+    FROM flat_schedules fs JOIN flat_timing ft ON ft.flat_schedule_iid=fs.iid
+    WHERE ft.location_iid=$1 AND fs.start_date=$2 ORDER BY fs.uid;""")
+
+# board.py, every board has the same shape, whether it's for arrivals or departures
+for board, column, public in [("departures", "departure_scheduled", "departure_public"), ("arrivals", "arrival_scheduled", "arrival_public")]:
+    for suffix, public_filter in [("", "AND sl.{} IS NOT NULL".format(public)), ("_all", "")]:
+        register("board", "board_" + board + suffix, ["VARCHAR(3)", "BIGINT", "BIGINT", "INTEGER"],
+            """SELECT fs.iid, fs.uid, fs.start_date, fs.trust_id, s.signalling_id, s.atoc_code,
+                ft.{column}, sl.{public}, sl.platform,
+                origin.name_normalised, destination.name_normalised,
+                fs.current_variation, current.name_normalised, fs.cancellation_datetime
+            FROM locations l
+            JOIN flat_timing ft ON ft.location_iid=l.iid
+            JOIN flat_schedules fs ON fs.iid=ft.flat_schedule_iid
+            JOIN schedules s ON s.validity_iid=fs.schedule_validity_iid
+            JOIN schedule_locations sl ON sl.iid=ft.schedule_location_iid
+            LEFT JOIN locations origin ON origin.iid=s.origin_location_iid
+            LEFT JOIN locations destination ON destination.iid=s.destination_location_iid
+            LEFT JOIN locations current ON current.iid=fs.current_location
+            WHERE l.crs=$1 AND ft.{column} >= $2 AND ft.{column} < $3 {public_filter}
+            ORDER BY ft.{column}, fs.iid LIMIT $4;""".format(column=column, public=public, public_filter=public_filter))
+register("board", "board_service", ["BIGINT"],
+    """SELECT l.tiploc, l.crs, l.name_normalised,
+        ft.arrival_scheduled, ft.departure_scheduled, ft.pass_scheduled,
+        sl.arrival_public, sl.departure_public, sl.platform, sl.line, sl.path, sl.activity
+    FROM flat_timing ft
+    JOIN locations l ON l.iid=ft.location_iid
+    JOIN schedule_locations sl ON sl.iid=ft.schedule_location_iid
+    WHERE ft.flat_schedule_iid=$1
+    ORDER BY ft.schedule_location_iid;""")
+
+# trust.py
+register("trust", "trust_activation", ["CHAR(10)", "CHAR(4)", "CHAR(8)", "BIGINT", "CODE", "CHAR(7)", "DATE"],
+    """UPDATE flat_schedules SET (trust_id, actual_signalling_id, actual_service_code, activation_datetime, train_call_type)=
+    ($1, $2, $3, $4, $5) WHERE uid=$6 AND start_date=$7;""")
+register("trust", "trust_upsert_flat_schedule", ["DATE", "CHAR(10)", "CHAR(4)", "CHAR(8)", "INTEGER", "INTEGER"],
+    """INSERT INTO flat_schedules
+    (start_date, trust_id, actual_signalling_id, actual_service_code, current_location, current_variation)
+    VALUES ($1, $2, $3, $4, (SELECT iid FROM locations WHERE stanox=$5 LIMIT 1), $6)
+    ON CONFLICT (start_date, trust_id) DO UPDATE SET (actual_service_code, current_location, current_variation)=
+    ($4, (SELECT iid FROM locations WHERE stanox=$5 ORDER BY crs LIMIT 1), $6)
+    RETURNING iid;""")
+register("trust", "trust_insert_movement", ["BIGINT", "INTEGER", "BIGINT", "BIGINT", "CODE", "VARCHAR(2)", "CODE", "CODE",
+    "CODE", "INTEGER", "CODE", "CODE"],
+    """INSERT INTO trust_movements
+    (flat_schedule_iid, stanox, datetime_scheduled, datetime_actual, movement_type,
+    actual_platform, actual_route, actual_line, actual_variation_status, actual_variation,
+    actual_direction, actual_source) VALUES
+    ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12);""")
+register("trust", "trust_identity_change", ["CHAR(10)", "CHAR(4)", "CHAR(10)"],
+    "UPDATE flat_schedules SET (trust_id, actual_signalling_id)=($1, $2) WHERE trust_id=$3;")
+for table, key, key_type in [("trust_punctuality_location", "stanox", "INTEGER"), ("trust_punctuality_toc", "toc_id", "CHAR(2)")]:
+    register("trust", "trust_upsert_" + table[6:], [key_type, "BIGINT"] + ["INTEGER"]*7 + ["BIGINT"],
+        """INSERT INTO {0} AS t VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+        ON CONFLICT ({1}, hour) DO UPDATE SET (movements, early, on_time, late_1, late_5, late_10, late_30, variation_sum)=
+        (t.movements+EXCLUDED.movements, t.early+EXCLUDED.early, t.on_time+EXCLUDED.on_time, t.late_1+EXCLUDED.late_1,
+        t.late_5+EXCLUDED.late_5, t.late_10+EXCLUDED.late_10, t.late_30+EXCLUDED.late_30, t.variation_sum+EXCLUDED.variation_sum);""".format(table, key))
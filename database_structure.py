@@ -7,10 +7,35 @@ import psycopg2, psycopg2.extras
 
 from common.database import DatabaseConnection
 
-def initialise(d):
+# Storage modes chosen at initialisation, which everything else has to go along with
+OPTIONS = ["deduplicate_patterns", "compact_codes"]
+
+# Databases initialised before swallow_options existed don't have any options enabled
+def options(c):
+    c.execute("SELECT to_regclass('swallow_options');")
+    if not c.fetchone()[0]:
+        return set()
+    c.execute("SELECT name FROM swallow_options;")
+    return set([a[0] for a in c.fetchall()])
+
+# Weekday masks are bitmasks with Monday as the least significant bit, single character codes are "char"
+def column_types(enabled_options):
+    if "compact_codes" in enabled_options:
+        return {"days": "SMALLINT", "code": '"char"', "code_fixed": '"char"'}
+    return {"days": "VARCHAR(7)", "code": "VARCHAR(1)", "code_fixed": "CHAR(1)"}
+
+def initialise(d, enabled_options=[]):
+    types = column_types(enabled_options)
     with d.new_cursor() as c:
         c.execute("BEGIN;")
 
+        c.execute("""CREATE TABLE swallow_options(
+            name VARCHAR(32) NOT NULL,
+            PRIMARY KEY(name)
+        );""")
+        for option in enabled_options:
+            c.execute("INSERT INTO swallow_options VALUES (%s);", (option,))
+
         c.execute("""CREATE TABLE headers(
         identity            CHAR(20),
         extract_date        DATE,
@@ -52,9 +77,9 @@ def initialise(d):
                 uid                       CHAR(6) NOT NULL,
                 valid_from                DATE    NOT NULL,
                 valid_to                  DATE    NOT NULL,
-                weekdays                  VARCHAR(7) NOT NULL,
-                bank_holiday_running      VARCHAR(1),
-                stp                       VARCHAR(1),
+                weekdays                  {days} NOT NULL,
+                bank_holiday_running      {code},
+                stp                       {code},
                 flattened_to              DATE DEFAULT NULL,
                 UNIQUE (uid, valid_from, stp)
             );
@@ -63,54 +88,78 @@ def initialise(d):
             CREATE INDEX idx_sched_validities_iid on schedule_validities(iid);
             CREATE INDEX idx_sched_validities_valid_from ON schedule_validities(valid_from);
             CREATE INDEX idx_sched_validities_stp ON schedule_validities(stp);
-            """)
+            """.format(**types))
+
+        # Whether weekdays/assoc_days include the day of the given date, for either encoding
+        c.execute("""CREATE OR REPLACE FUNCTION runs_on(days SMALLINT, day DATE) RETURNS BOOLEAN AS $$
+            SELECT (days >> (EXTRACT(ISODOW FROM day)::INTEGER - 1)) & 1 = 1;
+        $$ LANGUAGE SQL IMMUTABLE;
+
+        CREATE OR REPLACE FUNCTION runs_on(days VARCHAR, day DATE) RETURNS BOOLEAN AS $$
+            SELECT substr(days, EXTRACT(ISODOW FROM day)::INTEGER, 1) = '1';
+        $$ LANGUAGE SQL IMMUTABLE;
+        """)
+
+        # Calling patterns shared by schedules, when deduplicate_patterns is enabled. hash is a SHA-1 of the locations
+        c.execute("""CREATE SEQUENCE schedule_pattern_iid_seq;
+        CREATE TABLE schedule_patterns(
+            iid  INTEGER UNIQUE NOT NULL DEFAULT nextval('schedule_pattern_iid_seq'),
+            hash CHAR(40) NOT NULL,
+            UNIQUE(hash),
+            PRIMARY KEY(iid)
+        );
+        ALTER SEQUENCE schedule_pattern_iid_seq OWNED BY schedule_patterns.iid;
+        """)
 
         c.execute("CREATE SEQUENCE schedule_iid_seq;")
         c.execute("""CREATE TABLE schedules(
             iid                       INTEGER UNIQUE NOT NULL DEFAULT nextval('schedule_iid_seq'),
             validity_iid              INTEGER UNIQUE NOT NULL REFERENCES schedule_validities(iid) ON DELETE CASCADE,
             segment_instance          SMALLINT NOT NULL,
-            status                    VARCHAR(1),
+            status                    {code},
             category                  VARCHAR(2),
             signalling_id             VARCHAR(4),
             headcode                  VARCHAR(4),
-            business_sector           VARCHAR(1),
+            business_sector           {code},
             power_type                VARCHAR(3),
             timing_load               VARCHAR(7),
             speed                     VARCHAR(3),
             operating_characteristics VARCHAR(6),
-            seating_class             VARCHAR(1),
-            sleepers                  VARCHAR(1),
-            reservations              VARCHAR(1),
+            seating_class             {code},
+            sleepers                  {code},
+            reservations              {code},
             catering                  VARCHAR(4),
             branding                  VARCHAR(4),
             traction_class            VARCHAR(4),
             uic_code                  VARCHAR(5),
             atoc_code                 VARCHAR(2),
-            applicable_timetable      VARCHAR(1),
+            applicable_timetable      {code},
             origin_location_iid       INTEGER REFERENCES locations(iid), -- | These can be NULL
             destination_location_iid  INTEGER REFERENCES locations(iid), -- | Cancellations don't have an origin or destination!
+            pattern_iid               INTEGER REFERENCES schedule_patterns(iid),
             unique (validity_iid, segment_instance),
             PRIMARY KEY (iid)
-        );""")
+        );""".format(**types))
         c.execute("ALTER SEQUENCE schedule_iid_seq OWNED BY schedules.iid;")
         c.execute("CREATE INDEX idx_sched_iid ON schedules(iid);")
+        c.execute("CREATE INDEX idx_sched_pattern_iid ON schedules(pattern_iid);")
 
         c.execute("""CREATE TABLE associations(
             uid            CHAR(6),
             uid_assoc      CHAR(6),
             valid_from     DATE,
             valid_to       DATE,
-            assoc_days     VARCHAR(7),
+            assoc_days     {days},
             category       VARCHAR(2),
-            date_indicator VARCHAR(1),
+            date_indicator {code},
             tiploc         VARCHAR(7),
             suffix         VARCHAR(1),
             suffix_assoc   VARCHAR(1),
-            type           VARCHAR(1),
-            stp            VARCHAR(1),
+            type           {code},
+            stp            {code},
+            flattened_to   DATE DEFAULT NULL,
             UNIQUE(uid, uid_assoc, valid_from, stp)
-        );""")
+        );""".format(**types))
         c.execute("CREATE INDEX idx_main_uid ON associations(uid);")
         c.execute("CREATE INDEX idx_assoc_uid ON associations(uid_assoc);")
 
@@ -132,12 +181,14 @@ def initialise(d):
             engineering_allowance VARCHAR(2),
             pathing_allowance     VARCHAR(2),
             performance_allowance VARCHAR(2),
+            pattern_iid           INTEGER REFERENCES schedule_patterns(iid) ON DELETE CASCADE, -- | Either this or schedule_iid
             PRIMARY KEY(iid)
         );
         ALTER SEQUENCE sched_location_iid_seq OWNED BY schedule_locations.iid;
 
         CREATE INDEX idx_sched_location_iid ON schedule_locations(iid);
         CREATE INDEX idx_sched_location_schedule ON schedule_locations(schedule_iid);
+        CREATE INDEX idx_sched_location_pattern ON schedule_locations(pattern_iid);
         """)
 
         c.execute("""CREATE TABLE flat_reconstitution(
@@ -158,7 +209,7 @@ def initialise(d):
             actual_service_code   CHAR(8)  DEFAULT NULL,
 
             activation_datetime   BIGINT   DEFAULT NULL,
-            train_call_type       CHAR(1)  DEFAULT NULL, -- A(utomatic)/M(anual)
+            train_call_type       {code_fixed} DEFAULT NULL, -- A(utomatic)/M(anual)
 
             cancellation_datetime BIGINT   DEFAULT NULL,
             cancellation_reason   CHAR(2)  DEFAULT NULL,
@@ -191,27 +242,45 @@ def initialise(d):
         CREATE TRIGGER trigger_flat_hole BEFORE DELETE ON flat_schedules FOR EACH ROW
             WHEN (current_setting('application_name') <> 'fs_maintain')
             EXECUTE PROCEDURE insert_flat_hole();
-        """)
+        """.format(**types))
 
         c.execute("""CREATE TABLE trust_movements(
             flat_schedule_iid       BIGINT  NOT NULL REFERENCES flat_schedules(iid) ON DELETE CASCADE,
             stanox                  INTEGER NOT NULL,
             datetime_scheduled      BIGINT,
             datetime_actual         BIGINT  NOT NULL,
-            movement_type           CHAR(1) NOT NULL,
+            movement_type           {code_fixed} NOT NULL,
             actual_platform         VARCHAR(2) DEFAULT NULL,
-            actual_route            CHAR(1) DEFAULT NULL,
-            actual_line             CHAR(1) DEFAULT NULL,
-            actual_variation_status CHAR(1) DEFAULT NULL,
+            actual_route            {code_fixed} DEFAULT NULL,
+            actual_line             {code_fixed} DEFAULT NULL,
+            actual_variation_status {code_fixed} DEFAULT NULL,
             actual_variation        INTEGER DEFAULT NULL,
-            actual_direction        CHAR(1) DEFAULT NULL,
-            actual_source           CHAR(1) DEFAULT NULL
-        );""")
-        c.execute("CREATE INDEX idx_trust_movements_datetime_scheduled ON trust_movements(datetime_scheduled);")
-        c.execute("CREATE INDEX idx_trust_movements_datetime_actual ON trust_movements(datetime_actual);")
+            actual_direction        {code_fixed} DEFAULT NULL,
+            actual_source           {code_fixed} DEFAULT NULL
+        );""".format(**types))
+        # Movements are inserted more or less in time order, so BRIN does the job for a fraction of the upkeep
+        c.execute("CREATE INDEX idx_trust_movements_datetime_scheduled ON trust_movements USING BRIN (datetime_scheduled);")
+        c.execute("CREATE INDEX idx_trust_movements_datetime_actual ON trust_movements USING BRIN (datetime_actual);")
         c.execute("CREATE INDEX idx_trust_movements_flat_sched_iid ON trust_movements(flat_schedule_iid);")
         c.execute("CREATE INDEX idx_trust_movements_stanox ON trust_movements(stanox);")
 
+        # Hourly punctuality, maintained by trust.py as movements arrive. Variation is in minutes, negative when early
+        for table, key in [("trust_punctuality_location", "stanox INTEGER NOT NULL"), ("trust_punctuality_toc", "toc_id CHAR(2) NOT NULL")]:
+            c.execute("""CREATE TABLE {}(
+                {},
+                hour           BIGINT  NOT NULL,
+                movements      INTEGER NOT NULL DEFAULT 0,
+                early          INTEGER NOT NULL DEFAULT 0,
+                on_time        INTEGER NOT NULL DEFAULT 0,
+                late_1         INTEGER NOT NULL DEFAULT 0, -- 1-4 minutes
+                late_5         INTEGER NOT NULL DEFAULT 0, -- 5-9
+                late_10        INTEGER NOT NULL DEFAULT 0, -- 10-29
+                late_30        INTEGER NOT NULL DEFAULT 0, -- 30+
+                variation_sum  BIGINT  NOT NULL DEFAULT 0,
+                PRIMARY KEY({}, hour)
+            );""".format(table, key, key.split()[0]))
+            c.execute("CREATE INDEX idx_{0}_hour ON {0} USING BRIN (hour);".format(table))
+
         c.execute("""CREATE TABLE flat_timing(
             flat_schedule_iid     BIGINT  NOT NULL REFERENCES flat_schedules(iid) ON DELETE CASCADE,
             schedule_location_iid BIGINT  NOT NULL REFERENCES schedule_locations(iid) ON DELETE CASCADE,
@@ -225,24 +294,57 @@ def initialise(d):
         CREATE INDEX idx_flat_arrival ON flat_timing(arrival_scheduled);
         CREATE INDEX idx_flat_departure ON flat_timing(departure_scheduled);
         CREATE INDEX idx_flat_pass ON flat_timing(pass_scheduled);
+
+        -- Boards and service details, see board.py. Covering, so that flat_timing itself needn't be visited
+        CREATE INDEX idx_flat_loc_departure ON flat_timing(location_iid, departure_scheduled)
+            INCLUDE (flat_schedule_iid, schedule_location_iid) WHERE departure_scheduled IS NOT NULL;
+        CREATE INDEX idx_flat_loc_arrival ON flat_timing(location_iid, arrival_scheduled)
+            INCLUDE (flat_schedule_iid, schedule_location_iid) WHERE arrival_scheduled IS NOT NULL;
+        CREATE INDEX idx_flat_sched_iid_sched_loc ON flat_timing(flat_schedule_iid, schedule_location_iid)
+            INCLUDE (location_iid, arrival_scheduled, departure_scheduled, pass_scheduled);
         """)
 
+        c.execute("""CREATE TABLE flat_associations(
+            flat_schedule_iid       BIGINT  NOT NULL REFERENCES flat_schedules(iid) ON DELETE CASCADE,
+            flat_schedule_iid_assoc BIGINT  NOT NULL REFERENCES flat_schedules(iid) ON DELETE CASCADE,
+            uid                     CHAR(6) NOT NULL,
+            uid_assoc               CHAR(6) NOT NULL,
+            date                    DATE    NOT NULL,
+            location_iid            INTEGER REFERENCES locations(iid) ON DELETE CASCADE,
+            category                VARCHAR(2),
+            date_indicator          {code},
+            suffix                  VARCHAR(1),
+            suffix_assoc            VARCHAR(1),
+            type                    {code}
+        );
+
+        CREATE INDEX idx_flat_assoc_flat_sched_iid ON flat_associations(flat_schedule_iid);
+        CREATE INDEX idx_flat_assoc_flat_sched_iid_assoc ON flat_associations(flat_schedule_iid_assoc);
+        CREATE INDEX idx_flat_assoc_uid_date ON flat_associations(uid, uid_assoc, date);
+        CREATE INDEX idx_flat_assoc_location_date ON flat_associations(location_iid, date);
+        """.format(**types))
+
         c.execute("COMMIT;")
 
 def purge(d):
     with d.new_cursor() as c:
         c.execute("""BEGIN;
+            DROP TABLE flat_associations;
             DROP TABLE flat_timing;
+            DROP TABLE trust_punctuality_toc;
+            DROP TABLE trust_punctuality_location;
             DROP TABLE trust_movements;
             DROP TABLE flat_schedules;
             DROP TABLE schedule_locations;
             DROP TABLE schedules;
+            DROP TABLE schedule_patterns;
             DROP TABLE schedule_validities;
 
             DROP TABLE flat_reconstitution;
             DROP TABLE associations;
             DROP TABLE headers;
             DROP TABLE locations;
+            DROP TABLE swallow_options;
             COMMIT;""")
 
 if __name__ == "__main__":
@@ -250,10 +352,12 @@ if __name__ == "__main__":
     action = parser.add_mutually_exclusive_group(required=True)
     action.add_argument('--init', action='store_true', help='Initialise database')
     action.add_argument('--purge', action='store_true', help='Drop all Swallow tables')
+    parser.add_argument('--deduplicate-patterns', action='store_true', help='Store identical calling patterns only once (with --init)')
+    parser.add_argument('--compact-codes', action='store_true', help='Store weekday masks as bitmasks and codes as "char" (with --init)')
     args = parser.parse_args()
     with DatabaseConnection() as d:
         if args.init:
-            initialise(d)
+            initialise(d, [a for a in OPTIONS if getattr(args, a)])
             print("Swallow tables initialised")
         elif args.purge:
             purge(d)
@@ -1,17 +1,28 @@
 #!/usr/bin/env python3
 
-import json, os, sys, datetime, multiprocessing, time, queue
+import json, os, sys, argparse, datetime, multiprocessing, time, queue
 from collections import Counter, OrderedDict
 
 import psycopg2, psycopg2.extras
 
-from common import database
+import database_prepared
+
+DURATION_DAYS = 14
+
+# Schedule location times are in half minutes, relative to midnight on the day the schedule starts
+def flat_times(date, arrival_time, departure_time, pass_time):
+    dt_offset = int(datetime.datetime.combine(date, datetime.time(0,0)).timestamp())
+    return [dt_offset+a*30 if a else None for a in (arrival_time, departure_time, pass_time)]
+
+# Weekday masks are either strings of 0/1, or bitmasks (compact_codes) with Monday as the least significant bit
+def runs_on(days, date):
+    if isinstance(days, int):
+        return bool(days >> date.weekday() & 1)
+    return days[date.weekday()]=="1"
 
 def flat_worker(q, return_queue):
-    with database.DatabaseConnection() as db_connection, db_connection.new_cursor() as c:
+    with database_prepared.Connection(groups=["flat"]) as connection, connection.cursor() as c:
         c.execute("BEGIN;")
-        c.execute("PREPARE insert_flat_schedule (INTEGER, CHAR(7), DATE) AS INSERT INTO flat_schedules VALUES (DEFAULT, $1, $2, $3) RETURNING iid;")
-        c.execute("PREPARE insert_flat_timing(BIGINT, BIGINT, INT, BIGINT, BIGINT, BIGINT) AS INSERT INTO flat_timing VALUES ($1, $2, $3, $4, $5, $6);")
         c.execute("set LOCAL application_name = 'fs_maintain';")
         count = 0
         insertion_batch = []
@@ -26,7 +37,7 @@ def flat_worker(q, return_queue):
                 uid, flatten_from, duration_days, reconstitution = queue_entry
             except (queue.Empty, ValueError) as e:
                 if insertion_batch:
-                    psycopg2.extras.execute_batch(c,"EXECUTE insert_flat_timing(%s, %s, %s, %s, %s, %s);", insertion_batch, page_size=100)
+                    psycopg2.extras.execute_batch(c, database_prepared.sql("insert_flat_timing"), insertion_batch, page_size=100)
                     insertion_batch.clear()
                     c.execute("COMMIT; BEGIN;")
                 if type(e) is ValueError:
@@ -39,21 +50,22 @@ def flat_worker(q, return_queue):
             # The trigger for flat schedule deletion can be activated even if it already exists
             # We don't want to trash schedules which exist already, that would be bad
             if reconstitution:
-                c.execute("SELECT uid FROM flat_schedules WHERE uid=%s AND start_date=%s", (uid, date))
+                c.execute("SELECT uid FROM flat_schedules WHERE uid=%s AND start_date=%s", (uid, flatten_from))
                 if c.fetchall():
-                    c.execute("DELETE FROM flat_reconstitution WHERE uid=%s AND start_date=%s", (uid, date))
+                    c.execute("DELETE FROM flat_reconstitution WHERE uid=%s AND start_date=%s", (uid, flatten_from))
                     continue
 
             # This means most important STP status (C) will be taken *last*
-            c.execute("SELECT iid, uid, stp, weekdays, valid_from, valid_to, flattened_to FROM schedule_validities WHERE uid=%s AND valid_to >= %s AND valid_from <= %s ORDER BY stp DESC;", (uid, flatten_from, end_date))
+            c.execute(database_prepared.sql("select_flat_validities"), (uid, flatten_from, end_date))
             schedules = c.fetchall()
+            earliest_change = None
             for date in date_range:
                 already_processed = False
                 schedule_iid = None
                 schedule_matches = 0
                 for col_iid, uid, stp, weekdays, valid_from, valid_to, flattened_to in schedules:
                     # If the schedule is valid on the given day
-                    if valid_from <= date and valid_to >= date and weekdays[date.weekday()]=="1":
+                    if valid_from <= date and valid_to >= date and runs_on(weekdays, date):
                         # In this instance, a flat schedule is highly likely to already exist
                         if flattened_to and flattened_to >= date:
                             already_processed = True
@@ -76,71 +88,135 @@ def flat_worker(q, return_queue):
                     # There's no particularly neat way to stop this triggering, so for now...
                     c.execute("DELETE FROM flat_schedules WHERE uid=%s and start_date=%s;", (uid, date))
                     c.execute("DELETE FROM flat_reconstitution WHERE uid=%s and start_date=%s;", (uid, date))
+                    earliest_change = earliest_change or date
 
                 if schedule_iid:
-                    dt_offset = int(datetime.datetime.combine(date, datetime.time(0,0)).timestamp())
-                    c.execute("EXECUTE insert_flat_schedule (%s, %s, %s);", (col_iid, uid, date))
+                    earliest_change = earliest_change or date
+                    c.execute(database_prepared.sql("insert_flat_schedule"), (col_iid, uid, date))
                     flat_schedule_iid = c.fetchone()[0]
-                    c.execute("SELECT iid, location_iid, arrival_time, departure_time, pass_time FROM schedule_locations WHERE schedule_iid=%s ORDER BY iid;", [schedule_iid])
+                    c.execute(database_prepared.sql("select_flat_locations"), [schedule_iid])
                     for sched_location_iid, location_iid, arrival_time, departure_time, pass_time in c.fetchall():
                         insertion_batch.append((
                             flat_schedule_iid, sched_location_iid, location_iid,
-                            dt_offset+arrival_time*30 if arrival_time else None,
-                            dt_offset+departure_time*30 if departure_time else None,
-                            dt_offset+pass_time*30 if pass_time else None
+                            *flat_times(date, arrival_time, departure_time, pass_time)
                             ))
 
-            if not reconstitution:
+            if reconstitution:
+                # Either the hole's been filled, or nothing's valid on the day any more (ie a deleted schedule),
+                # and leaving it would have it queued again on every pass
+                c.execute("DELETE FROM flat_reconstitution WHERE uid=%s AND start_date=%s;", (uid, flatten_from))
+            else:
                 c.execute("UPDATE schedule_validities SET flattened_to=%s WHERE uid=%s;", (end_date, uid))
 
+            # Flat associations have to be linked up again if their flat schedules changed, including those
+            # for the previous day, which might be associated with a service starting the next day
+            if earliest_change:
+                c.execute("UPDATE associations SET flattened_to=%s WHERE (uid=%s OR uid_assoc=%s) AND flattened_to >= %s;",
+                    (earliest_change - datetime.timedelta(days=2), uid, uid, earliest_change - datetime.timedelta(days=1)))
+
             if count%100==0:
-                psycopg2.extras.execute_batch(c, "EXECUTE insert_flat_timing(%s, %s, %s, %s, %s, %s);", insertion_batch, page_size=100)
+                psycopg2.extras.execute_batch(c, database_prepared.sql("insert_flat_timing"), insertion_batch, page_size=100)
                 insertion_batch.clear()
                 c.execute("COMMIT; BEGIN;")
 
-with database.DatabaseConnection() as db_connection, db_connection.new_cursor() as c:
-    worker_count = 4
-    uid_queues = []
-    occupation_queue = multiprocessing.Queue()
+# Associated services don't necessarily start on the same day as the main service
+DATE_INDICATOR_OFFSETS = {
+    "S": 0,
+    "N": 1,
+    "P": -1,
+    }
+
+def flatten_associations(c, flatten_from, duration_days):
+    date_range = [flatten_from + datetime.timedelta(days=a) for a in range(duration_days+1)]
+    end_date = date_range[-1]
+
+    c.execute("BEGIN;")
+    c.execute("SELECT DISTINCT uid, uid_assoc FROM associations WHERE valid_to >= %s AND valid_from <= %s AND (flattened_to < %s OR flattened_to IS NULL);", (flatten_from, end_date, end_date))
+    for uid, uid_assoc in c.fetchall():
+        # As with schedules, the most important STP status (C) will be taken *last*
+        c.execute(database_prepared.sql("select_flat_associations"), (uid, uid_assoc, flatten_from, end_date))
+        associations = c.fetchall()
+
+        # A single unflattened (new or replaced) record means the whole window has to be redone
+        flattened_to = min([a[-1] or datetime.date.min for a in associations])
+
+        for date in date_range:
+            if flattened_to >= date:
+                continue
+
+            # An association is identified by its location, only the last valid record for each one counts
+            effective = {}
+            for tiploc, stp, assoc_days, valid_from, valid_to, *details, _ in associations:
+                if valid_from <= date and valid_to >= date and runs_on(assoc_days, date):
+                    effective[tiploc] = None if stp=="C" else details
 
-    for i in range(worker_count):
-        uid_queues.append(multiprocessing.Queue())
-        p = multiprocessing.Process(target=flat_worker, args=(uid_queues[-1], occupation_queue))
-        p.start()
+            c.execute("DELETE FROM flat_associations WHERE uid=%s AND uid_assoc=%s AND date=%s;", (uid, uid_assoc, date))
+            for tiploc, details in effective.items():
+                if not details:
+                    continue
+                category, date_indicator, suffix, suffix_assoc, type = details
+                assoc_date = date + datetime.timedelta(days=DATE_INDICATOR_OFFSETS.get(date_indicator, 0))
+                # Nothing is inserted unless both services actually run
+                c.execute(database_prepared.sql("insert_flat_association"),
+                    (uid, uid_assoc, date, tiploc, category, date_indicator, suffix, suffix_assoc, type, assoc_date))
+
+        c.execute("UPDATE associations SET flattened_to=%s WHERE uid=%s AND uid_assoc=%s;", (end_date, uid, uid_assoc))
+    c.execute("COMMIT;")
 
-    duration_days = 14
-    start_date = datetime.datetime.now().date()
-    end_date = start_date + datetime.timedelta(duration_days)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=DURATION_DAYS, help="Number of days to flatten ahead, see lazy_flat.py for beyond")
+    args = parser.parse_args()
 
-    workers_occupied = 0
+    with database_prepared.Connection(groups=["flat"]) as connection, connection.cursor() as c:
+        worker_count = 4
+        uid_queues = []
+        occupation_queue = multiprocessing.Queue()
 
-    while True:
-        if not workers_occupied:
-            c.execute("SELECT DISTINCT uid FROM schedule_validities WHERE valid_to >= %s AND valid_from <= %s AND (flattened_to < %s OR flattened_to IS NULL);", (start_date, end_date, end_date))
-            uids = [a[0] for a in c.fetchall()]
+        for i in range(worker_count):
+            uid_queues.append(multiprocessing.Queue())
+            p = multiprocessing.Process(target=flat_worker, args=(uid_queues[-1], occupation_queue))
+            p.start()
 
-            for i, uid in enumerate(uids):
-                uid_queues[i%worker_count].put((uid, start_date, duration_days, False))
+        duration_days = args.days
+        start_date = datetime.datetime.now().date()
+        end_date = start_date + datetime.timedelta(duration_days)
 
-            if c.rowcount:
-                workers_occupied = worker_count
+        workers_occupied = 0
+
+        while True:
+            if not workers_occupied:
+                c.execute("SELECT DISTINCT uid FROM schedule_validities WHERE valid_to >= %s AND valid_from <= %s AND (flattened_to < %s OR flattened_to IS NULL);", (start_date, end_date, end_date))
+                uids = [a[0] for a in c.fetchall()]
 
-            c.execute("SELECT uid,start_date FROM flat_reconstitution;")
-            for i, (uid, date) in enumerate(c.fetchall()):
-                uid_queues[i%worker_count].put((uid, date, 1, True))
+                for i, uid in enumerate(uids):
+                    uid_queues[i%worker_count].put((uid, start_date, duration_days, False))
 
-            if c.rowcount:
-                workers_occupied = worker_count
+                if c.rowcount:
+                    workers_occupied = worker_count
 
-                # Heavily suggest the workers should commit the remaining insert batch
-                for i in range(worker_count):
-                    uid_queues[i].put(None)
+                c.execute("SELECT uid,start_date FROM flat_reconstitution;")
+                for i, (uid, date) in enumerate(c.fetchall()):
+                    uid_queues[i%worker_count].put((uid, date, 1, True))
 
-        sys.stdout.write("\r" + ", ".join(["{:<7}".format(a.qsize()) for a in uid_queues]))
-        sys.stdout.flush()
-        try:
-            workers_occupied -= occupation_queue.get(True, 2)
-            print()
-            print("Worker complete")
-        except queue.Empty as e:
-            pass
+                if c.rowcount:
+                    workers_occupied = worker_count
+
+                if workers_occupied:
+                    # Heavily suggest the workers should commit the remaining insert batch
+                    for i in range(worker_count):
+                        uid_queues[i].put(None)
+                else:
+                    flatten_associations(c, start_date, duration_days)
+
+            sys.stdout.write("\r" + ", ".join(["{:<7}".format(a.qsize()) for a in uid_queues]))
+            sys.stdout.flush()
+            try:
+                workers_occupied -= occupation_queue.get(True, 2)
+                print()
+                print("Worker complete")
+                # Only linked up once every flat schedule queued so far has been committed
+                if not workers_occupied:
+                    flatten_associations(c, start_date, duration_days)
+            except queue.Empty as e:
+                pass
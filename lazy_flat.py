@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import argparse, datetime, time
+from collections import OrderedDict
+
+import database_prepared
+from flat_maintenance import flat_times
+
+# Rows are (schedule_validity_iid, schedule_location_iid, location_iid, arrival, departure, pass), the same as flat_timing
+class LazyFlattener:
+    def __init__(self, cursor, cached_days=28, refresh_interval=300):
+        self.cursor = cursor
+        self.cached_days = cached_days
+        self.refresh_interval = refresh_interval
+        # date -> {uid: rows}, least recently used first
+        self._days = OrderedDict()
+        self.schedule_version = None
+        self.refresh()
+
+    def refresh(self):
+        c = self.cursor
+        # Anything between these dates is left to flat_maintenance.py
+        c.execute("SELECT MIN(start_date), MAX(start_date) FROM flat_schedules WHERE uid IS NOT NULL;")
+        materialised_from, materialised_to = c.fetchone()
+        self.materialised_from = materialised_from or datetime.date.max
+        self.materialised_to = materialised_to or datetime.date.min
+        for date in [a for a in self._days if self._materialised(a)]:
+            del self._days[date]
+
+        # Every CIF file parsed adds a header, any of them could have changed what's been memoised
+        c.execute("SELECT extract_date, extract_time, current_reference FROM headers ORDER BY extract_date DESC, extract_time DESC LIMIT 1;")
+        schedule_version = c.fetchone()
+        if schedule_version != self.schedule_version:
+            self._days.clear()
+            self.schedule_version = schedule_version
+        self.refreshed = time.monotonic()
+
+    def _materialised(self, date):
+        return self.materialised_from <= date <= self.materialised_to
+
+    def _refresh_if_stale(self):
+        if time.monotonic()-self.refreshed >= self.refresh_interval:
+            self.refresh()
+
+    def _day(self, date):
+        if date in self._days:
+            self._days.move_to_end(date)
+        else:
+            self._days[date] = {}
+            while len(self._days) > self.cached_days:
+                self._days.popitem(last=False)
+        return self._days[date]
+
+    # Flattens whichever of the uids haven't been already, all at once
+    def _flatten(self, uids, date):
+        day = self._day(date)
+        missing = [a for a in uids if a not in day]
+        if missing:
+            for uid in missing:
+                day[uid] = []
+            self.cursor.execute(database_prepared.sql("select_lazy_flat_uids"), (missing, date))
+            for uid, validity_iid, sched_location_iid, location_iid, arrival_time, departure_time, pass_time in self.cursor.fetchall():
+                day[uid].append((validity_iid, sched_location_iid, location_iid, *flat_times(date, arrival_time, departure_time, pass_time)))
+        return day
+
+    def uid(self, uid, date):
+        self._refresh_if_stale()
+        if self._materialised(date):
+            self.cursor.execute(database_prepared.sql("select_materialised_uid"), (uid, date))
+            return self.cursor.fetchall()
+        return self._flatten([uid], date)[uid]
+
+    # uid -> rows at the location, for schedules starting on the given date
+    def location(self, location_iid, date):
+        self._refresh_if_stale()
+        c = self.cursor
+        calls = OrderedDict()
+        if self._materialised(date):
+            c.execute(database_prepared.sql("select_materialised_location"), (location_iid, date))
+            for uid, *row in c.fetchall():
+                calls.setdefault(uid, []).append(tuple(row))
+            return calls
+
+        c.execute(database_prepared.sql("select_lazy_uids"), (location_iid, date))
+        uids = sorted([a[0] for a in c.fetchall()])
+        day = self._flatten(uids, date)
+        for uid in uids:
+            rows = [a for a in day[uid] if a[2]==location_iid]
+            if rows:
+                calls[uid] = rows
+        return calls
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("date", type=datetime.date.fromisoformat)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--uid")
+    target.add_argument("--tiploc")
+    args = parser.parse_args()
+
+    with database_prepared.Connection(groups=["flat"]) as connection, connection.cursor() as c:
+        flattener = LazyFlattener(c)
+        if args.uid:
+            calls = {args.uid: flattener.uid(args.uid, args.date)}
+        else:
+            c.execute("SELECT iid FROM locations WHERE tiploc=%s;", (args.tiploc,))
+            calls = flattener.location(c.fetchone()[0], args.date)
+
+        for uid, rows in calls.items():
+            for validity_iid, sched_location_iid, location_iid, *times in rows:
+                print(uid, location_iid, *[datetime.datetime.fromtimestamp(a).strftime("%Y-%m-%dT%H:%M") if a else "-" for a in times])
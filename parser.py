@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 
-import json, os, sys, argparse, datetime
+import json, os, sys, argparse, datetime, hashlib
 from collections import Counter, OrderedDict
 
 import psycopg2, psycopg2.extras
 
 from common import database
+import database_prepared, database_structure
 
 def c_str(string):
     return string.rstrip()
@@ -23,6 +24,10 @@ def c_date(string):
 def c_date_dmy(string):
     return "20" + string[4:6] + "-" + string[2:4] + "-" + string[0:2]
 
+# Days running as a bitmask, Monday being the least significant bit
+def c_days(string):
+    return int(string[::-1], 2)
+
 def c_num(string):
     if string.strip():
         return int(string.strip())
@@ -46,12 +51,17 @@ def incorporate_corpus(include_nalco_only):
                     tiploc, entry["NLC"], *fetch_names(tiploc, tps_desc), stanox, crs])
         c.execute("COMMIT;")
 
-def parse_cif(f):
+def parse_cif(f, connection=None):
+    if not connection:
+        with database_prepared.Connection(groups=["cif"]) as connection:
+            return parse_cif(f, connection)
+
     start_timestamp = datetime.datetime.now().timestamp()
-    with database.DatabaseConnection() as db_connection, db_connection.new_cursor() as c:
+    with connection.cursor() as c:
         count = 0
         location_batch = []
         location_delete_batch = []
+        pattern_location_batch = []
 
         # Inline selects for tiploc/iid mappings presents a major bottleneck, and it should all fit in memory easily enough
         tl_map = {}
@@ -59,8 +69,16 @@ def parse_cif(f):
         for tiploc,iid in c:
             tl_map[tiploc] = iid
 
-        c.execute("PREPARE location_plan (INTEGER, INTEGER, VARCHAR(1), SMALLINT, SMALLINT, SMALLINT, VARCHAR(4), VARCHAR(4), VARCHAR(3), VARCHAR(3), VARCHAR(3), VARCHAR(12), VARCHAR(2), VARCHAR(2), VARCHAR(2)) AS INSERT INTO schedule_locations VALUES (DEFAULT, $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15);")
-        c.execute("PREPARE location_delete_plan (INTEGER) AS DELETE FROM schedule_locations WHERE schedule_iid=$1;")
+        # Identical calling patterns are stored once, and referenced by each schedule which uses them
+        enabled_options = database_structure.options(c)
+        deduplicate_patterns = "deduplicate_patterns" in enabled_options
+        compact_codes = "compact_codes" in enabled_options
+        days = c_days if compact_codes else c_str
+        pattern_map = {}
+        if deduplicate_patterns:
+            c.execute("SELECT hash,iid FROM schedule_patterns;")
+            for pattern_hash,iid in c:
+                pattern_map[pattern_hash] = iid
 
         c.execute("BEGIN;")
         while True:
@@ -74,10 +92,12 @@ def parse_cif(f):
                 sys.stdout.write("\r%8s %s" % (count, record_type))
                 sys.stdout.flush()
                 # These are are the largest part of the schedule, the less time wasted the better
-                psycopg2.extras.execute_batch(c,"EXECUTE location_delete_plan (%s);", location_delete_batch)
+                psycopg2.extras.execute_batch(c, database_prepared.sql("delete_schedule_locations"), location_delete_batch)
                 location_delete_batch.clear()
-                psycopg2.extras.execute_batch(c,"EXECUTE location_plan (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);", location_batch, page_size=100)
+                psycopg2.extras.execute_batch(c, database_prepared.sql("insert_schedule_location"), location_batch, page_size=100)
                 location_batch.clear()
+                psycopg2.extras.execute_batch(c, database_prepared.sql("insert_pattern_location"), pattern_location_batch, page_size=100)
+                pattern_location_batch.clear()
 
             if record_type == "HD":
                 identity, extract_date, extract_time, current_ref, last_ref = (
@@ -93,16 +113,15 @@ def parse_cif(f):
             if record_type == "AA":
                 transaction_type=line[0]
                 if transaction_type in "NR":
-                    c.execute("""INSERT INTO associations VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        ON CONFLICT (uid, uid_assoc, valid_from, stp)
-                        DO UPDATE SET (valid_to, assoc_days, category, date_indicator, tiploc, suffix, suffix_assoc, type)=
-                        (EXCLUDED.valid_to, EXCLUDED.assoc_days, EXCLUDED.category, EXCLUDED.date_indicator, EXCLUDED.tiploc,
-                        EXCLUDED.suffix, EXCLUDED.suffix_assoc, EXCLUDED.type);""",
-                        [line[1:7], line[7:13], c_date(line[13:19]), c_date(line[19:25]), line[25:32],
+                    c.execute(database_prepared.sql("upsert_association"),
+                        [line[1:7], line[7:13], c_date(line[13:19]), c_date(line[19:25]), days(line[25:32]),
                         c_str_n(line[32:34]), line[34], c_str(line[35:42]), c_num(line[42]), c_num(line[43]),
                         line[45], line[77]])
                 else:
-                    c.execute("DELETE FROM associations WHERE uid=%s AND uid_assoc=%s AND valid_from=%s AND stp=%s;", (line[1:7], line[7:13], c_date(line[13:19]), line[77]))
+                    c.execute(database_prepared.sql("delete_association"), (line[1:7], line[7:13], c_date(line[13:19]), line[77]))
+                    # Whatever this association overlaid has to be flattened again
+                    c.execute("DELETE FROM flat_associations WHERE uid=%s AND uid_assoc=%s;", (line[1:7], line[7:13]))
+                    c.execute("UPDATE associations SET flattened_to=NULL WHERE uid=%s AND uid_assoc=%s;", (line[1:7], line[7:13]))
 
             # TI c_str(l[0:7])->tiploc, c_num(l[7:9])->caps_ident, c_num(l[9:15])->nlc, l[15]->nlc_check, c_str(l[16:42])->description_tps, l[42:47]->stanox, c_num(l[47:51])->pomcp, c_str_n(l[51:54])->crs, c_str(l[54:70])->description_nlc
             elif record_type == "TI" or record_type == "TA":
@@ -132,24 +151,11 @@ def parse_cif(f):
                 if transaction_type in "NR":
                     # Used to ensure that BS/CR are properly replaced
                     segment_id = 0
-                    c.execute("""INSERT INTO schedule_validities
-                        VALUES (DEFAULT, %s, %s, %s, %s, %s, %s)
-                        ON CONFLICT (uid, valid_from, stp) DO
-                            UPDATE SET (uid, valid_from, valid_to, weekdays, bank_holiday_running, stp)=
-                            (EXCLUDED.uid, EXCLUDED.valid_from, EXCLUDED.valid_to, EXCLUDED.weekdays, EXCLUDED.bank_holiday_running, EXCLUDED.stp)
-                        RETURNING iid;""",
-                        [line[1:7], c_date(line[7:13]), c_date(line[13:19]), line[19:26], line[26], line[77]])
+                    c.execute(database_prepared.sql("upsert_schedule_validity"),
+                        [line[1:7], c_date(line[7:13]), c_date(line[13:19]), days(line[19:26]), line[26], line[77]])
                     sv_id = c.fetchone()[0]
 
-                    c.execute("""INSERT INTO schedules VALUES (DEFAULT, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        ON CONFLICT (validity_iid, segment_instance) DO UPDATE SET (status, category, signalling_id,
-                            headcode, business_sector, power_type, timing_load, speed, operating_characteristics, seating_class, sleepers,
-                            reservations, catering, branding, traction_class, uic_code, atoc_code, applicable_timetable)=(
-                            EXCLUDED.status, EXCLUDED.category,
-                            EXCLUDED.signalling_id, EXCLUDED.headcode, EXCLUDED.business_sector, EXCLUDED.power_type, EXCLUDED.timing_load,
-                            EXCLUDED.speed, EXCLUDED.operating_characteristics, EXCLUDED.seating_class, EXCLUDED.sleepers,
-                            EXCLUDED.reservations, EXCLUDED.catering, EXCLUDED.branding, EXCLUDED.traction_class, EXCLUDED.uic_code,
-                            EXCLUDED.atoc_code, EXCLUDED.applicable_timetable) RETURNING iid;""",
+                    c.execute(database_prepared.sql("upsert_schedule"),
                         [sv_id, segment_id, line[27],
                         line[28:30], c_str_n(line[30:34]), c_str_n(line[34:38]), line[47], c_str_n(line[48:51]),
                         c_str_n(line[51:55]), c_str_n(line[55:58]), line[58:64], c_str_n(line[64]), c_str_n(line[65]),
@@ -170,6 +176,7 @@ def parse_cif(f):
                 if record_type=="LO":
                     # Clear the midnight comparison values
                     last_time, time_offset = 0,0
+                    pattern = []
                     if transaction_type=="R":
                         location_delete_batch.append((bs_id,))
                         c.execute("UPDATE schedule_validities SET flattened_to=NULL WHERE iid=%s;", [sv_id])
@@ -211,20 +218,38 @@ def parse_cif(f):
                 if public_arrival == "0000": public_arrival = None
                 if public_departure == "0000": public_departure = None
 
-                location_batch.append((
-                    bs_id, tl_map[tiploc], tiploc_instance, arrival, departure, pass_time, public_arrival, public_departure,
+                location = (
+                    tl_map[tiploc], tiploc_instance, arrival, departure, pass_time, public_arrival, public_departure,
                     platform, sched_line, path, activity, engineering_allowance, pathing_allowance, performance_allowance
-                    ))
+                    )
+
+                if not deduplicate_patterns:
+                    location_batch.append((bs_id, *location))
+                else:
+                    pattern.append(location)
+                    if record_type=="LT":
+                        pattern_hash = hashlib.sha1(repr(pattern).encode()).hexdigest()
+                        if pattern_hash not in pattern_map:
+                            c.execute(database_prepared.sql("insert_pattern"), (pattern_hash,))
+                            pattern_map[pattern_hash] = c.fetchone()[0]
+                            pattern_location_batch.extend([(pattern_map[pattern_hash], *a) for a in pattern])
+                        c.execute(database_prepared.sql("update_schedule_pattern"), (pattern_map[pattern_hash], bs_id))
 
             elif record_type == "ZZ":
                 duration = int(datetime.datetime.now().timestamp()-start_timestamp)
                 print("\r%8s ZZ %ss" % (count, duration))
 
                 # If there's any left, it'd be a good idea to store them!
-                psycopg2.extras.execute_batch(c,"EXECUTE location_delete_plan (%s);", location_delete_batch)
+                psycopg2.extras.execute_batch(c, database_prepared.sql("delete_schedule_locations"), location_delete_batch)
                 location_delete_batch.clear()
-                psycopg2.extras.execute_batch(c,"EXECUTE location_plan (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);", location_batch, page_size=100)
+                psycopg2.extras.execute_batch(c, database_prepared.sql("insert_schedule_location"), location_batch, page_size=100)
                 location_batch.clear()
+                psycopg2.extras.execute_batch(c, database_prepared.sql("insert_pattern_location"), pattern_location_batch, page_size=100)
+                pattern_location_batch.clear()
+
+                if deduplicate_patterns:
+                    # Patterns which were replaced or deleted, and aren't used by anything else
+                    c.execute("DELETE FROM schedule_patterns p WHERE NOT EXISTS (SELECT 1 FROM schedules s WHERE s.pattern_iid=p.iid);")
 
                 if update_indicator=="F":
                     print("Building indexes")
@@ -1,14 +1,22 @@
 #!/usr/bin/env python3
 
 import logging
-from time import sleep
+from time import sleep, time
+import sys
+import threading
+import hashlib
 import json
 import datetime
+import argparse
+import multiprocessing
+import queue
 from collections import Counter, OrderedDict
 
 import stomp
+import psycopg2.extras
 
-from common import database, config
+from common import config
+import trust_live, database_prepared
 
 def f_timestamp(timestamp):
     if not timestamp:
@@ -66,7 +74,36 @@ VARIATION_TYPES = {
     "OFF ROUTE":"-",
     }
 
-def connect_and_subscribe(mq):
+# Punctuality rollup columns, after movements: early, on_time, late_1, late_5, late_10, late_30
+LATENESS_BUCKETS = [1, 5, 10, 30]
+
+def punctuality_row(variation_status, variation):
+    row = [1, 0, 0, 0, 0, 0, 0, variation]
+    if variation_status=="E":
+        row[1] = 1
+    elif variation<=0:
+        row[2] = 1
+    else:
+        row[2+len([a for a in LATENESS_BUCKETS if variation>=a])] = 1
+    return row
+
+def accumulate(rollup, key, row):
+    if key in rollup:
+        rollup[key] = [a+b for a,b in zip(rollup[key], row)]
+    else:
+        rollup[key] = row
+
+# Returns the client ID and (destination, durable subscription name) pairs for a consumer
+def subscriptions(shard=None, shards=None):
+    if shard is None:
+        return config.get("nr-username"), [(config.get("trust-subscribe"), config.get("trust-identifier"))]
+    # Durable subscriptions belong to a client ID, so each consumer needs its own. It's derived from the topics rather
+    # than the shard, so that the same topics always come back to the same subscriptions
+    topics = config.get("trust-shard-topics")[shard::shards]
+    return "{}-{}".format(config.get("nr-username"), hashlib.sha1(" ".join(sorted(topics)).encode()).hexdigest()[:8]), [
+        (topic, "{}-{}".format(config.get("trust-identifier"), topic.split("/")[-1])) for topic in topics]
+
+def connect_and_subscribe(mq, client_id, destinations):
     for n in range(1,32):
         try:
             log.info("Connecting... (attempt %s)" % n)
@@ -75,33 +112,49 @@ def connect_and_subscribe(mq):
                 "username": config.get("nr-username"),
                 "passcode": config.get("nr-password"),
                 "wait": True,
-                "client-id": config.get("nr-username"),
-                })
-            mq.subscribe(**{
-                "destination": config.get("trust-subscribe"),
-                "id": 1,
-                "ack": "client-individual",
-                "activemq.subscriptionName": config.get("trust-identifier"),
+                "client-id": client_id,
                 })
-            log.info("Connected!")
-            return
+            for i, (destination, subscription_name) in enumerate(destinations, 1):
+                mq.subscribe(**{
+                    "destination": destination,
+                    "id": i,
+                    "ack": "client-individual",
+                    "activemq.subscriptionName": subscription_name,
+                    })
+            log.info("Connected as %s to %s" % (client_id, ", ".join([a[0] for a in destinations])))
+            return True
         except Exception as e:
             log.exception("Failed to connect. Next attempt in {}s".format(n**2))
             sleep(n**2)
     log.error("Connection attempts exhausted")
+    return False
 
 class Listener(stomp.ConnectionListener):
     def __init__(self, mq, cursor):
         self._mq = mq
         self.cursor = cursor
+        self.messages, self.records = 0, 0
+        self._counts_lock = threading.Lock()
+
+    # Counts are incremented on the receiver thread, so have to be swapped out under the lock
+    def take_counts(self):
+        with self._counts_lock:
+            counts = (self.messages, self.records)
+            self.messages, self.records = 0, 0
+        return counts
 
     def on_message(self, headers, message):
         c = self.cursor
 
         self._mq.ack(id=headers['message-id'], subscription=headers['subscription'])
         parsed = json.loads(message)
+        with self._counts_lock:
+            self.messages += 1
+            self.records += len(parsed)
 
         c.execute("BEGIN;")
+        deltas = []
+        location_rollup, toc_rollup = {}, {}
         for train in parsed:
             try:
                 head = train["header"]
@@ -114,7 +167,7 @@ class Listener(stomp.ConnectionListener):
                 headcode, tspeed = trust_id[2:6], trust_id[6]
 
                 if type=="0001": # Activation
-                    c.execute("UPDATE flat_schedules SET (trust_id, actual_signalling_id, actual_service_code, activation_datetime, train_call_type)=(%s, %s, %s, %s, %s) WHERE uid=%s AND start_date=%s;", (trust_id, headcode, body["train_service_code"], convert_ts(body["creation_timestamp"]), body["train_call_type"][0], body["train_uid"], body["tp_origin_timestamp"]))
+                    c.execute(database_prepared.sql("trust_activation"), (trust_id, headcode, body["train_service_code"], convert_ts(body["creation_timestamp"]), body["train_call_type"][0], body["train_uid"], body["tp_origin_timestamp"]))
                 elif type=="0002": # Cancellation
                     pass
                 elif type=="0003": # Movement
@@ -126,29 +179,33 @@ class Listener(stomp.ConnectionListener):
                     if direction_ind:
                         direction_ind = direction_ind[0]
 
-                    c.execute("""INSERT INTO flat_schedules
-                        (start_date, trust_id, actual_signalling_id, actual_service_code, current_location, current_variation)
-                        VALUES (%s, %s, %s, %s, (SELECT iid FROM locations WHERE stanox=%s LIMIT 1), %s)
-                        ON CONFLICT (start_date, trust_id) DO UPDATE SET (actual_service_code, current_location, current_variation)=
-                        (%s, (SELECT iid FROM locations WHERE stanox=%s ORDER BY crs LIMIT 1), %s)
-                        RETURNING iid;""", (date_today(), trust_id, headcode, body['train_service_code'], body['loc_stanox'], relative_variation,
-                            body['train_service_code'], body['loc_stanox'], relative_variation))
-
-                    c.execute("""INSERT INTO trust_movements
-                        (flat_schedule_iid, stanox, datetime_scheduled, datetime_actual, movement_type,
-                        actual_platform, actual_route, actual_line, actual_variation_status, actual_variation,
-                        actual_direction, actual_source) VALUES
-                        (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);""", (
+                    c.execute(database_prepared.sql("trust_upsert_flat_schedule"), (
+                        date_today(), trust_id, headcode, body['train_service_code'], body['loc_stanox'], relative_variation))
+
+                    c.execute(database_prepared.sql("trust_insert_movement"), (
                         c.fetchone()[0], body["loc_stanox"], convert_ts(body["planned_timestamp"]) or None, convert_ts(body["actual_timestamp"]),
                         MOVEMENT_TYPES[body["planned_event_type"]], body["platform"], body["route"], body["line_ind"],
                         VARIATION_TYPES[body["variation_status"]], body["timetable_variation"], direction_ind,
                         body["event_source"][0]))
+                    # Minutes late, negative if early, as in the punctuality rollups
+                    variation_status = VARIATION_TYPES[body["variation_status"]]
+                    variation = int(body["timetable_variation"])
+                    if variation_status=="E":
+                        variation = -variation
+                    deltas.append([trust_id, int(body["loc_stanox"]), variation, convert_ts(body["actual_timestamp"])])
+
+                    if variation_status in "OEL":
+                        row = punctuality_row(variation_status, variation)
+                        hour = convert_ts(body["actual_timestamp"])//3600*3600
+                        accumulate(location_rollup, (int(body["loc_stanox"]), hour), row)
+                        if toc_id:
+                            accumulate(toc_rollup, (toc_id, hour), row)
                 elif type=="0005": # Reinstatement
                     pass
                 elif type=="0006": # Origin change
                     pass
                 elif type=="0007": # Identity change
-                    c.execute("UPDATE flat_schedules SET (trust_id,actual_signalling_id)=(%s,%s) WHERE trust_id=%s;",
+                    c.execute(database_prepared.sql("trust_identity_change"),
                         (body["revised_train_id"], body["revised_train_id"][2:6], trust_id))
                 elif type=="0008":
                     pass
@@ -157,26 +214,118 @@ class Listener(stomp.ConnectionListener):
                     continue
             except Exception as e:
                 log.exception("Failed to insert individual record")
+        try:
+            # Sorted, so that row locks are always taken in the same order
+            psycopg2.extras.execute_batch(c, database_prepared.sql("trust_upsert_punctuality_location"),
+                [(*k, *v) for k,v in sorted(location_rollup.items())])
+            psycopg2.extras.execute_batch(c, database_prepared.sql("trust_upsert_punctuality_toc"),
+                [(*k, *v) for k,v in sorted(toc_rollup.items())])
+        except Exception as e:
+            log.exception("Failed to update punctuality")
+        try:
+            trust_live.publish(c, deltas)
+        except Exception as e:
+            log.exception("Failed to publish movement deltas")
         c.execute("COMMIT;")
 
     def on_error(self, headers, message):
         print('received an error "%s"' % message)
 
+    # Reconnection is left to consume()
     def on_heartbeat_timeout(self):
         log.error("Heartbeat timeout")
-        self._mq.set_listener("swallow", self)
-        connect_and_subscribe(self._mq)
 
     def on_disconnected(self):
         log.error("Disconnected")
 
 
-mq = stomp.Connection([('datafeeds.networkrail.co.uk', 61618)],
-    keepalive=True, heartbeats=(10000, 10000))
+REPORT_INTERVAL = 60
+
+def consume(shard=None, shards=None, report_queue=None):
+    client_id, destinations = subscriptions(shard, shards)
+    mq = stomp.Connection([('datafeeds.networkrail.co.uk', 61618)],
+        keepalive=True, heartbeats=(10000, 10000))
+
+    with database_prepared.Connection(groups=["trust"]) as connection, connection.cursor() as cursor:
+        listener = Listener(mq, cursor)
+        mq.set_listener('swallow', listener)
+        last_report = time()
+        while True:
+            # Covers heartbeat timeouts as well as disconnection, whatever restarts trust.py (ie supervise) takes it from there
+            if not mq.is_connected() and not connect_and_subscribe(mq, client_id, destinations):
+                sys.exit(1)
+            sleep(5)
+            if report_queue and time()-last_report >= REPORT_INTERVAL:
+                report_queue.put((shard, *listener.take_counts()))
+                last_report = time()
+
+# Durable subscriptions stay on the broker, buffering messages, until they're removed
+def unsubscribe(shards):
+    # As in supervise()
+    shards = min(shards, len(config.get("trust-shard-topics")))
+    for shard in range(shards):
+        client_id, destinations = subscriptions(shard, shards)
+        mq = stomp.Connection([('datafeeds.networkrail.co.uk', 61618)])
+        mq.start()
+        mq.connect(**{
+            "username": config.get("nr-username"),
+            "passcode": config.get("nr-password"),
+            "wait": True,
+            "client-id": client_id,
+            })
+        for i, (destination, subscription_name) in enumerate(destinations, 1):
+            # Buffered messages aren't acknowledged, so they go with the subscription
+            mq.subscribe(**{
+                "destination": destination,
+                "id": i,
+                "ack": "client-individual",
+                "activemq.subscriptionName": subscription_name,
+                })
+            mq.unsubscribe(id=i, headers={"activemq.subscriptionName": subscription_name})
+            log.info("Unsubscribed %s from %s" % (client_id, destination))
+        mq.disconnect()
 
-with database.DatabaseConnection() as db_connection, db_connection.new_cursor() as cursor:
-    mq.set_listener('swallow', Listener(mq, cursor))
-    connect_and_subscribe(mq)
+# Runs a consumer for each share of trust-shard-topics, restarting any which exit
+def supervise(shards):
+    topics = config.get("trust-shard-topics")
+    if shards > len(topics):
+        log.warning("Only %s topics to share between %s consumers" % (len(topics), shards))
+        shards = len(topics)
+    report_queue = multiprocessing.Queue()
+    processes, started, restarts = [None]*shards, [0]*shards, [0]*shards
 
     while True:
-        sleep(5)
+        for n in range(shards):
+            if processes[n] and processes[n].is_alive():
+                continue
+            if processes[n]:
+                # Don't go hammering the broker if something's consistently wrong
+                if time()-started[n] < 30:
+                    continue
+                restarts[n] += 1
+                log.error("Consumer %s exited with %s, restarting (%s restarts)" % (n, processes[n].exitcode, restarts[n]))
+            processes[n] = multiprocessing.Process(target=consume, args=(n, shards, report_queue), daemon=True)
+            processes[n].start()
+            started[n] = time()
+
+        try:
+            shard, messages, records = report_queue.get(True, 5)
+            log.info("Consumer %s: %s messages, %s records in the last %ss, %s restarts" % (
+                shard, messages, records, REPORT_INTERVAL, restarts[shard]))
+        except queue.Empty as e:
+            pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--consumers", "-c", type=int, default=0,
+        help="Run this many consumer processes, sharing trust-shard-topics between them")
+    parser.add_argument("--unsubscribe", type=int, metavar="CONSUMERS",
+        help="Remove the durable subscriptions used by --consumers CONSUMERS, then exit")
+    args = parser.parse_args()
+
+    if args.unsubscribe:
+        unsubscribe(args.unsubscribe)
+    elif args.consumers:
+        supervise(args.consumers)
+    else:
+        consume()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import json, select, datetime
+
+from common import database
+
+CHANNEL = "trust_movements"
+# NOTIFY payloads have to be shorter than 8000 bytes, this leaves plenty of headroom
+PAYLOAD_LIMIT = 7000
+
+# Each delta is [trust_id, stanox, variation, datetime_actual]
+def publish(c, deltas):
+    payloads, current = [], []
+    for delta in deltas:
+        current.append(delta)
+        if len(json.dumps(current, separators=(",", ":"))) > PAYLOAD_LIMIT:
+            payloads.append(current[:-1])
+            current = [delta]
+    if current:
+        payloads.append(current)
+    for payload in payloads:
+        # Held by the server until the transaction in progress is committed
+        c.execute("SELECT pg_notify(%s, %s);", (CHANNEL, json.dumps(payload, separators=(",", ":"))))
+
+class LiveView:
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.connection = cursor.connection
+        # trust_id -> (stanox, variation, datetime_actual)
+        self.trains = {}
+
+    # Listening first, so that nothing committed in between is missed, then starting from each train's last movement
+    def listen(self, since=None):
+        c = self.cursor
+        c.execute("LISTEN {};".format(CHANNEL))
+        since = since or datetime.date.today() - datetime.timedelta(days=1)
+        c.execute("""SELECT fs.trust_id, tm.stanox,
+                CASE WHEN tm.actual_variation_status='E' THEN -tm.actual_variation ELSE tm.actual_variation END, tm.datetime_actual
+            FROM flat_schedules fs
+            JOIN LATERAL (SELECT stanox, actual_variation, actual_variation_status, datetime_actual FROM trust_movements
+                WHERE flat_schedule_iid=fs.iid ORDER BY datetime_actual DESC LIMIT 1) tm ON TRUE
+            WHERE fs.start_date >= %s AND fs.trust_id IS NOT NULL;""", (since,))
+        for trust_id, stanox, variation, datetime_actual in c.fetchall():
+            self.trains[trust_id] = (stanox, variation, datetime_actual)
+
+    def update(self, timeout=None):
+        if timeout is not None and select.select([self.connection], [], [], timeout) == ([], [], []):
+            return []
+        self.connection.poll()
+        deltas = []
+        while self.connection.notifies:
+            notify = self.connection.notifies.pop(0)
+            for trust_id, stanox, variation, datetime_actual in json.loads(notify.payload):
+                last = self.trains.get(trust_id)
+                # Notifications from separate transactions aren't necessarily in movement order
+                if last and last[2] and datetime_actual and last[2] > datetime_actual:
+                    continue
+                self.trains[trust_id] = (stanox, variation, datetime_actual)
+                deltas.append((trust_id, stanox, variation, datetime_actual))
+        return deltas
+
+    # Trains activated yesterday can still be running, but anything older can go
+    def expire(self, before):
+        for trust_id in [k for k,v in self.trains.items() if v[2] and v[2] < before]:
+            del self.trains[trust_id]
+
+if __name__ == "__main__":
+    with database.DatabaseConnection() as db_connection, db_connection.new_cursor() as c:
+        view = LiveView(c)
+        view.listen()
+        while True:
+            for trust_id, stanox, variation, datetime_actual in view.update(5):
+                print("{} {:<6} {:>+4} {}".format(trust_id, stanox, variation,
+                    datetime.datetime.utcfromtimestamp(datetime_actual).strftime("%H:%M:%S") if datetime_actual else ""))
+            view.expire(int(datetime.datetime.now().timestamp()) - 2*86400)